@@ -13,7 +13,12 @@ License: MIT
 
 
 from time import ticks_diff, ticks_add, ticks_ms, sleep_ms
+from struct import unpack_from
+from binascii import hexlify
 from machine import Pin, Signal
+from micropython import const
+import micropython
+import select
 
 try:
     import CAN
@@ -23,46 +28,117 @@ except ImportError:
 
 #: Dictionary of supported PIDs mapped to
 #: (PID code, decode function, unit string).
+#: Decoders take (data, offset) and read the value straight out of the response buffer.
 supported_pids: dict[str, tuple] = {
-    'monitor_status': (0x01, lambda data: data, 'Bit encoded'),  # Monitor status since DTCs cleared
-    'fuel_status': (0x03, lambda data: data, 'Bit encoded'),  # Fuel system status
-    'engine_load': (0x04, lambda data: (data[0] * 100) / 255, '%'),  # Calculated engine load
-    'coolant_temp': (0x05, lambda data: data[0] - 40, '°C'),  # Engine coolant temperature
-    'stft_bank1': (0x06, lambda data: (data[0] * 100 / 128) - 100, '%'),  # Short term fuel trim—Bank 1
-    'ltft_bank1': (0x07, lambda data: (data[0] * 100 / 128) - 100, '%'),  # Long term fuel trim—Bank 1
-    'intake_press': (0x0B, lambda data: data[0], 'kPa'),  # Intake manifold absolute pressure
-    'rpm': (0x0C, lambda data: ((data[0] << 8) + data[1]) / 4.0, 'rpm'),  # Engine speed
-    'speed': (0x0D, lambda data: data[0], 'km/h'),  # Vehicle speed
-    'timing_adv': (0x0E, lambda data: (data[0] / 2.0) - 64, '° before TDC'),  # Timing advance
-    'intake_temp': (0x0F, lambda data: data[0] - 40, '°C'),  # Intake air temperature
-    'maf': (0x10, lambda data: ((data[0] << 8) + data[1]) / 100.0, 'g/s'),  # Mass air flow sensor
-    'throttle_pos': (0x11, lambda data: (data[0] * 100) / 255, '%'),  # Throttle position
-    'o2_sensors': (0x13, lambda data: data, 'Bit encoded'),  # Oxygen sensors present
-    'o2_s1_bank1': (0x14, lambda data: ((data[0] / 200.0), (data[1] * 100 / 128) - 100 if data[1] != 0xFF else None),
+    'monitor_status': (0x01, lambda mv, o: mv[o:], 'Bit encoded'),  # Monitor status since DTCs cleared
+    'fuel_status': (0x03, lambda mv, o: mv[o:], 'Bit encoded'),  # Fuel system status
+    'engine_load': (0x04, lambda mv, o: (mv[o] * 100) / 255, '%'),  # Calculated engine load
+    'coolant_temp': (0x05, lambda mv, o: mv[o] - 40, '°C'),  # Engine coolant temperature
+    'stft_bank1': (0x06, lambda mv, o: (mv[o] * 100 / 128) - 100, '%'),  # Short term fuel trim—Bank 1
+    'ltft_bank1': (0x07, lambda mv, o: (mv[o] * 100 / 128) - 100, '%'),  # Long term fuel trim—Bank 1
+    'intake_press': (0x0B, lambda mv, o: mv[o], 'kPa'),  # Intake manifold absolute pressure
+    'rpm': (0x0C, lambda mv, o: unpack_from('>H', mv, o)[0] / 4.0, 'rpm'),  # Engine speed
+    'speed': (0x0D, lambda mv, o: mv[o], 'km/h'),  # Vehicle speed
+    'timing_adv': (0x0E, lambda mv, o: (mv[o] / 2.0) - 64, '° before TDC'),  # Timing advance
+    'intake_temp': (0x0F, lambda mv, o: mv[o] - 40, '°C'),  # Intake air temperature
+    'maf': (0x10, lambda mv, o: unpack_from('>H', mv, o)[0] / 100.0, 'g/s'),  # Mass air flow sensor
+    'throttle_pos': (0x11, lambda mv, o: (mv[o] * 100) / 255, '%'),  # Throttle position
+    'o2_sensors': (0x13, lambda mv, o: mv[o:], 'Bit encoded'),  # Oxygen sensors present
+    'o2_s1_bank1': (0x14, lambda mv, o: ((mv[o] / 200.0), (mv[o + 1] * 100 / 128) - 100 if mv[o + 1] != 0xFF else None),
                     'V, %'),  # O2 Sensor 1 Bank 1: Voltage, Short term fuel trim
-    'o2_s2_bank1': (0x15, lambda data: ((data[0] / 200.0), (data[1] * 100 / 128) - 100 if data[1] != 0xFF else None),
+    'o2_s2_bank1': (0x15, lambda mv, o: ((mv[o] / 200.0), (mv[o + 1] * 100 / 128) - 100 if mv[o + 1] != 0xFF else None),
                     'V, %'),  # Oxygen Sensor 2: Voltage, Short term fuel trim
-    'run_time': (0x1F, lambda data: (data[0] << 8) + data[1], 's'),  # Run time since engine start
-    'mil_dist': (0x21, lambda data: (data[0] << 8) + data[1], 'km'),  # Distance traveled with MIL on
-    'evap_purge': (0x2E, lambda data: (data[0] * 100) / 255, '%'),  # Commanded evaporative purge
-    'fuel_level': (0x2F, lambda data: (data[0] * 100) / 255, '%'),  # Fuel Tank Level Input
-    'warm_ups': (0x30, lambda data: data[0], 'count'),  # Warm-ups since codes cleared
-    'clr_dist': (0x31, lambda data: (data[0] << 8) + data[1], 'km'),  # Distance traveled since codes cleared
-    'baro_press': (0x33, lambda data: data[0], 'kPa'),  # Absolute Barometric Pressure
-    'o2_s1_ratio': (0x34, lambda data: ((data[0] << 8) + data[1]) * 2 / 65536, 'ratio'),
+    'run_time': (0x1F, lambda mv, o: unpack_from('>H', mv, o)[0], 's'),  # Run time since engine start
+    'mil_dist': (0x21, lambda mv, o: unpack_from('>H', mv, o)[0], 'km'),  # Distance traveled with MIL on
+    'evap_purge': (0x2E, lambda mv, o: (mv[o] * 100) / 255, '%'),  # Commanded evaporative purge
+    'fuel_level': (0x2F, lambda mv, o: (mv[o] * 100) / 255, '%'),  # Fuel Tank Level Input
+    'warm_ups': (0x30, lambda mv, o: mv[o], 'count'),  # Warm-ups since codes cleared
+    'clr_dist': (0x31, lambda mv, o: unpack_from('>H', mv, o)[0], 'km'),  # Distance traveled since codes cleared
+    'baro_press': (0x33, lambda mv, o: mv[o], 'kPa'),  # Absolute Barometric Pressure
+    'o2_s1_ratio': (0x34, lambda mv, o: unpack_from('>H', mv, o)[0] * 2 / 65536, 'ratio'),
     # Oxygen Sensor 1: Air-Fuel Equivalence Ratio
-    'volt_module': (0x42, lambda data: ((data[0] << 8) + data[1]) / 1000.0, 'V'),  # Control module voltage
-    'abs_load': (0x43, lambda data: ((data[0] << 8) + data[1]) * 100 / 255, '%'),  # Absolute load value
-    'cmd_air_fuel': (0x44, lambda data: ((data[0] << 8) + data[1]) * 2 / 65536, 'ratio'),
+    'volt_module': (0x42, lambda mv, o: unpack_from('>H', mv, o)[0] / 1000.0, 'V'),  # Control module voltage
+    'abs_load': (0x43, lambda mv, o: unpack_from('>H', mv, o)[0] * 100 / 255, '%'),  # Absolute load value
+    'cmd_air_fuel': (0x44, lambda mv, o: unpack_from('>H', mv, o)[0] * 2 / 65536, 'ratio'),
     # Commanded Air-Fuel Equivalence Ratio
-    'rel_throttle': (0x45, lambda data: (data[0] * 100) / 255, '%'),  # Relative throttle position
-    'throttle_b': (0x47, lambda data: (data[0] * 100) / 255, '%'),  # Absolute throttle position B
-    'accel_d': (0x49, lambda data: (data[0] * 100) / 255, '%'),  # Accelerator pedal position D
-    'cmd_throttle': (0x4C, lambda data: (data[0] * 100) / 255, '%'),  # Commanded throttle actuator
-    'time_run_mil': (0x41, lambda data: (data[0] << 8) + data[1], 'min'),  # Time run with MIL on
-    'time_since_dtc': (0x4D, lambda data: (data[0] << 8) + data[1], 'min')  # Time since DTCs cleared
+    'rel_throttle': (0x45, lambda mv, o: (mv[o] * 100) / 255, '%'),  # Relative throttle position
+    'throttle_b': (0x47, lambda mv, o: (mv[o] * 100) / 255, '%'),  # Absolute throttle position B
+    'accel_d': (0x49, lambda mv, o: (mv[o] * 100) / 255, '%'),  # Accelerator pedal position D
+    'cmd_throttle': (0x4C, lambda mv, o: (mv[o] * 100) / 255, '%'),  # Commanded throttle actuator
+    'time_run_mil': (0x41, lambda mv, o: unpack_from('>H', mv, o)[0], 'min'),  # Time run with MIL on
+    'time_since_dtc': (0x4D, lambda mv, o: unpack_from('>H', mv, o)[0], 'min')  # Time since DTCs cleared
 }
 
+#: 0xCC padding tails for request frames, indexed by the number of pad bytes.
+_CC_PADS: tuple = tuple((0xCC,) * i for i in range(9))
+
+#: CAN identifiers as (request ID, (first, last) response ID, filter mask, filter shift).
+#: The shift aligns the ID with the raw acceptance filter register.
+STD_IDS: tuple = (0x7DF, (0x7E8, 0x7EF), 0x7F8, 21)  # 111 1110 1XXX / 111 1111 1000
+EXT_IDS: tuple = (0x18DB33F1, (0x18DAF100, 0x18DAF1EF), 0x1FFFFF00, 3)  # 1 1000 1101 1010 1111 0001 XXXX XXXX
+
+#: Two-digit uppercase hex for every byte value, e.g. _HEX2[0x4A] == b'4A'.
+_HEX2: list[bytes] = [f'{i:02X}'.encode() for i in range(256)]
+#: Single hex digit for every nibble value.
+_HEX1: list[bytes] = [_HEX2[i][1:] for i in range(16)]
+#: Offsets of the set bits in every byte value, MSB first, e.g. _BYTE_BITS[0xA0] == b'\x00\x02'.
+_BYTE_BITS: list[bytes] = [bytes(b for b in range(8) if (v << b) & 0x80) for v in range(256)]
+#: DTC system letter and first digit indexed by the high nibble of the first byte.
+_DTC_PREFIX: list[bytes] = [f'{c}{i}'.encode() for c in 'PCBU' for i in range(4)]
+
+#: Frame classes returned in the low 2 bits of _classify().
+_SKIP = const(0)
+_SF = const(1)  # single frame, accepted
+_FF = const(2)  # first frame, accepted, total length in the upper bits
+_CF = const(3)  # expected consecutive frame
+
+
+@micropython.viper
+def _classify(frame, n: int, req: int, seq: int) -> int:
+    """
+    Classify a received ISO-TP frame against the pending request.
+
+    Args:
+        frame: Raw CAN data (n bytes).
+        n (int): Frame length.
+        req (int): Packed request, service_id | pid_code << 8 | payload length << 16.
+        seq (int): 0x10 | expected consecutive frame sequence during a multi-frame transfer, else 0.
+
+    Returns:
+        int: Frame class in bits 0-1, multi-frame length in the upper bits for _FF.
+    """
+    if n < 1:
+        return _SKIP
+    d = ptr8(frame)
+    d0 = int(d[0])
+    pci = d0 >> 4
+    if seq & 0x10: # wait for consecutive frame (CF), sequence is the low nibble
+        if pci == 2 and (d0 & 0x0F) == (seq & 0x0F):
+            return _CF
+        return _SKIP
+
+    svc = (req & 0xFF) + 0x40 # response service_id
+    pid = (req >> 8) & 0xFF
+    nreq = req >> 16
+    if pci == 0: # single frame (SF): echoes service_id (+ pid_code), fits one frame
+        if d0 < nreq or d0 > 7 or n <= d0:
+            return _SKIP
+        if int(d[1]) != svc:
+            return _SKIP
+        if nreq > 1 and int(d[2]) != pid:
+            return _SKIP
+        return _SF
+    if pci == 1: # first frame (FF)
+        if n < 8:
+            return _SKIP
+        length = ((d0 & 0x0F) << 8) | int(d[1])
+        if length <= 7 or int(d[2]) != svc:
+            return _SKIP
+        if nreq > 1 and int(d[3]) != pid:
+            return _SKIP
+        return (length << 2) | _FF
+    return _SKIP
+
 
 class OBD2CAN:
     """
@@ -101,21 +177,21 @@ class OBD2CAN:
         
         self.debug = debug
         self.extframe = extframe
+        self._tx_cache: dict[tuple, tuple] = {}  # padded frames keyed by payload
 
-        if not extframe:
-            self._reqs_id: int = 0x7DF
-            self._resp_id: tuple[int, int] = (0x7E8, 0x7EF) # 111 1110 1XXX
-            filter_mask: int = 0x7F8                        # 111 1111 1000
-            filter_params: list[int] = [self._resp_id[0] << 21, ~(filter_mask << 21) & 0xFFFFFFFF]
-        else:
-            self._reqs_id: int = 0x18DB33F1 #(0x18DA00F1, 0x18DAEFF1)
-            self._resp_id: tuple[int, int] = (0x18DAF100, 0x18DAF1EF)   # 1 1000 1101 1010 1111 0001 XXXX XXXX
-            filter_mask: int = 0x1FFFFF00                               # 1 1111 1111 1111 1111 1111 0000 0000
-            filter_params: list[int] = [self._resp_id[0] << 3, ~(filter_mask << 3) & 0xFFFFFFFF]
+        self._reqs_id, self._resp_id, filter_mask, filter_shift = EXT_IDS if extframe else STD_IDS
+        filter_params: list[int] = [self._resp_id[0] << filter_shift, ~(filter_mask << filter_shift) & 0xFFFFFFFF]
+        self._resp_lo, self._resp_hi = self._resp_id
 
         self.can = CAN(0, tx=tx, rx=rx, mode=mode, bitrate=bitrate, extframe=extframe)
         self.can.set_filters(bank=0, mode=CAN.FILTER_RAW_SINGLE, params=filter_params, extframe=extframe)
 
+        try: # wait for frames without spinning where the driver is pollable
+            self._poller = select.poll()
+            self._poller.register(self.can, select.POLLIN)
+        except Exception:
+            self._poller = None
+
         print(f'\n{' CAN0 UP ':-^29}\n')
         self.blink(False)
 
@@ -130,15 +206,15 @@ class OBD2CAN:
             self.blink(False)
         print(f'\n{' CAN0 DOWN ':-^29}\n')
 
-    def log(self, *msg: str) -> None:
-        """Print debug messages if debug mode is enabled."""
+    def log(self, *msg) -> None:
+        """Print debug messages if debug mode is enabled, hex-formatting byte buffers lazily."""
         if self.debug:
-            print('CAN: [DEBUG]', *msg)
+            print('CAN: [DEBUG]', *(self.to_hex(m) if isinstance(m, (bytes, bytearray, memoryview)) else m for m in msg))
 
     @staticmethod
     def to_hex(data):
         """Convert byte sequence into hex string."""
-        return ' '.join(f'{x:02X}' for x in data)
+        return hexlify(bytes(data), ' ').decode().upper()
 
     def send(self, *payload: int, retries: int = 3) -> bool:
         """
@@ -151,22 +227,29 @@ class OBD2CAN:
         Returns:
             bool: True if send succeeded, False otherwise.
         """
-        msg: bytes = bytes(list(payload) + [0xCC] * (8 - len(payload)))
+        msg: tuple | None = self._tx_cache.get(payload)
+        if msg is None:
+            if len(self._tx_cache) >= 16: # polling loops only use a handful of frames
+                self._tx_cache.clear()
+            msg = payload + _CC_PADS[8 - len(payload)] # the TWAI driver reads frame data as a list or tuple
+            self._tx_cache[payload] = msg
+
         success: bool = False
+        self.blink(True)
         while not success:
-            self.blink(True)
             try:
                 self.can.clear_rx_queue()
-                self.can.send(list(msg), self._reqs_id, rtr=False, extframe=self.extframe)
-                self.log('REQUEST  >>', self.to_hex(msg))
+                self.can.send(msg, self._reqs_id, rtr=False, extframe=self.extframe)
+                if self.debug:
+                    self.log('REQUEST  >>', self.to_hex(msg))
                 success = True
             except Exception as e:
                 if retries > 1:
                     retries -= 1
-                    self.blink(False)
                     sleep_ms(50)
                 else:
-                    self.log('ERROR sending request:', self.to_hex(msg), str(e))
+                    if self.debug:
+                        self.log('ERROR sending request:', self.to_hex(msg), str(e))
                     break
         self.blink(False)
         return success
@@ -185,71 +268,70 @@ class OBD2CAN:
         if not self.send(len(payload), *payload):
             return None
 
-        multiframe_seq: int = 0
-        rx_timeout = ticks_add(ticks_ms(), timeout_ms)
-        while ticks_diff(rx_timeout, ticks_ms()) > 0:
-            if not self.can.any():
-                continue
+        # bind hot-path callables once, locals are cheaper than global/attribute lookups
+        _ticks_ms, _ticks_diff, _ticks_add = ticks_ms, ticks_diff, ticks_add
+        _any, _recv = self.can.any, self.can.recv
+        _poll = None if self._poller is None else self._poller.poll
+        resp_lo, resp_hi, extframe = self._resp_lo, self._resp_hi, self.extframe
 
-            can_id, is_ext, is_rtr, data = self.can.recv()
-            if self._resp_id[0] > can_id > self._resp_id[1]:
-                continue
-            if is_rtr or (is_ext != self.extframe):
-                continue
+        req: int = payload[0] | len(payload) << 16
+        if len(payload) > 1:
+            req |= payload[1] << 8
 
-            self.blink(True)
-            data_mv = memoryview(data)
-            self.blink(False)
-
-            pci = data_mv[0] >> 4
-            if multiframe_seq: # wait for consecutive frame (CF)
-                if pci != 2:
-                    continue
-                seq = data_mv[0] & 0x0F
-                if seq != multiframe_seq:
-                    continue
-                self.log('RESPONSE <<', self.to_hex(data_mv))
-                multiframe_seq = (multiframe_seq + 1) & 0x0F # wrap at 15
-                multiframe_buf.extend(data_mv[1:])
-                if len(multiframe_buf) < multiframe_len:
-                    rx_timeout = ticks_add(ticks_ms(), timeout_ms)
+        self.blink(True) # one on/off pair for the whole receive phase
+        try:
+            multiframe_seq: int = 0
+            rx_timeout = _ticks_add(_ticks_ms(), timeout_ms)
+            while _ticks_diff(rx_timeout, _ticks_ms()) > 0:
+                if not _any():
+                    if _poll is None:
+                        sleep_ms(1)
+                    else:
+                        _poll(max(0, _ticks_diff(rx_timeout, _ticks_ms())))
                     continue
-                return memoryview(multiframe_buf[:multiframe_len])
 
-            elif pci == 0: # single frame (SF)
-                if len(payload) >= data_mv[0] >= 8:
-                    continue
-                if data_mv[1] != (payload[0] + 0x40): # response service_id
-                    continue
-                try:
-                    if data_mv[2] != payload[1]: # pid_code
-                        continue
-                except IndexError:
-                    pass
-                self.log('RESPONSE <<', self.to_hex(data_mv))
-                return data_mv[1:1 + data_mv[0]]
-
-            elif pci == 1: # first frame (FF)
-                multiframe_len = ((data_mv[0] & 0x0F) << 8) | data_mv[1]
-                multiframe_buf = bytearray()
-                multiframe_seq = 1
-                if multiframe_len <= 7:
+                # cheapest and most selective checks first, foreign ECUs are rejected on the ID
+                can_id, is_ext, is_rtr, data = _recv()
+                if can_id < resp_lo or can_id > resp_hi:
                     continue
-                if data_mv[2] != (payload[0] + 0x40): # response service_id
+                if is_ext != extframe or is_rtr:
                     continue
-                try:
-                    if data_mv[3] != payload[1]: # pid_code
-                        continue
-                except IndexError:
-                    pass
-                self.log('RESPONSE <<', self.to_hex(data_mv))
-                multiframe_buf.extend(data_mv[2:])
-                if not self.send(0x30, 0x00, 0x00): # flow control
-                    return None
-                rx_timeout = ticks_add(ticks_ms(), timeout_ms)
 
-        self.log(f'RESPONSE << {'TIMEOUT':-^23}')
-        return None
+                data_mv = memoryview(data)
+                action = _classify(data_mv, len(data_mv), req, multiframe_seq)
+                kind = action & 3
+
+                if kind == _CF: # consecutive frame
+                    self.log('RESPONSE <<', data_mv)
+                    multiframe_seq = 0x10 | ((multiframe_seq + 1) & 0x0F) # in transfer, sequence wraps 0xF -> 0x0
+                    chunk = min(multiframe_len - multiframe_pos, len(data_mv) - 1)
+                    multiframe_buf[multiframe_pos:multiframe_pos + chunk] = data_mv[1:1 + chunk]
+                    multiframe_pos += chunk
+                    if multiframe_pos < multiframe_len:
+                        rx_timeout = _ticks_add(_ticks_ms(), timeout_ms)
+                        continue
+                    return memoryview(multiframe_buf)
+
+                elif kind == _SF: # single frame
+                    self.log('RESPONSE <<', data_mv)
+                    return data_mv[1:1 + data_mv[0]]
+
+                elif kind == _FF: # first frame
+                    multiframe_len = action >> 2
+                    multiframe_buf = bytearray(multiframe_len) # allocated once, filled in place
+                    multiframe_buf[:6] = data_mv[2:8] # FF carries the first 6 bytes
+                    multiframe_pos = 6
+                    multiframe_seq = 0x11 # in transfer, first CF has sequence 1
+                    self.log('RESPONSE <<', data_mv)
+                    if not self.send(0x30, 0x00, 0x00): # flow control, turns the LED off
+                        return None
+                    self.blink(True)
+                    rx_timeout = _ticks_add(_ticks_ms(), timeout_ms)
+
+            self.log(f'RESPONSE << {'TIMEOUT':-^23}')
+            return None
+        finally:
+            self.blink(False)
 
     def get_supported_pid(self, vehicle: bool = False) -> bytes:
         """
@@ -267,11 +349,16 @@ class OBD2CAN:
             if response is None:
                 break
 
-            pid_mask = int.from_bytes(bytes(response[2:]), "big")
-            for i in range(31):
-                if pid_mask & (1 << (31 - i)):
-                    result.append(pid_code + i + 1)
-            if pid_mask & 1:
+            if len(response) < 6: # service_id, pid_code, 4 mask bytes
+                break
+
+            next_window = response[5] & 1 # bit 0 flags the next 0x20 window, not a PID
+            for i in range(4):
+                base = pid_code + 8 * i + 1
+                mask_byte = response[2 + i] if i < 3 else response[5] & 0xFE
+                for offset in _BYTE_BITS[mask_byte]:
+                    result.append(base + offset)
+            if next_window:
                 pid_code += 0x20
                 sleep_ms(50)
             else:
@@ -304,15 +391,14 @@ class OBD2CAN:
             if dtc_bytes_num == 1 and dtc_bytes[0] == 0:
                 self.log("DTC: No fault codes found.")
             return []
-        elif dtc_bytes_num % 2 != 0:
+        elif dtc_bytes_num & 1:
             self.log("ERROR: DTC bytes is not in pairs (2 bytes per code)")
             return []
 
-        base_map = ['P', 'C', 'B', 'U']
         codes = []
         for i in range(0, len(dtc_bytes), 2):
             a, b = dtc_bytes[i], dtc_bytes[i+1]
-            codes.append(f'{base_map[a >> 6]}{(a >> 4) & 3}{a & 0xF}{b >> 4}{b & 0xF}'.encode('ascii'))
+            codes.append(_DTC_PREFIX[a >> 4] + _HEX1[a & 0xF] + _HEX2[b])
         return codes
 
     def get_vin(self) -> bytes:
@@ -360,9 +446,9 @@ class OBD2CAN:
             return None
 
         try:
-            return supported_pids[pid_str][1](response[2:]) # pid sepecific lambda function call
+            return supported_pids[pid_str][1](response, 2) # pid specific decoder, data starts after service_id and pid_code
         except Exception as e:
-            self.log('ERROR decoding response:', self.to_hex(response), str(e))
+            self.log('ERROR decoding response:', response, str(e))
             return None
 
 